@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# sweeps easy_task transports over payload size, stage count, fan_out and queue depth:
+#   python easy_bench.py --payloads scalar 480p 4k --stages 1 3 --fan-out 1 2 --queue-size 1 4
+# run_case() is the unit a pytest-benchmark fixture would time, e.g. benchmark.pedantic(run_case, args=...)
+
+from multiprocessing import Queue
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+
+from easy_task import TaskPipeline, TaskPipelineV2, ShmNumpy, ShmRing, ShmSpsc, ICallable, State
+
+
+PAYLOADS = {
+    'scalar': None,
+    '64': (64, 64, 3),
+    '480p': (480, 640, 3),
+    '1080p': (1080, 1920, 3),
+    '4k': (2160, 3840, 3),
+}
+
+TRANSPORTS = ('queue', 'queue+shm', 'pipe+shm', 'ring', 'spsc')
+
+# user space copies of the payload per hop: pickle in and out of the pipe, or one write into shared memory
+COPIES = {'queue': 2, 'queue+shm': 1, 'pipe+shm': 1, 'ring': 1, 'spsc': 1}
+
+
+class Source(ICallable):
+    def __init__(self, shape):
+        self.shape = shape
+
+    def init(self):
+        self.frame = None if self.shape is None else np.zeros(self.shape, dtype=np.uint8)
+
+    def __call__(self, n):
+        for i in range(n):
+            yield time.monotonic(), i if self.frame is None else self.frame
+        yield State.STOP
+
+
+def passthrough(x):
+    return x
+
+
+def sink(x):
+    return x[0], time.monotonic()
+
+
+class ShmSource(ICallable):
+    # TaskPipelineV2 stages get the shms of the link before and after them as extra arguments
+    def __init__(self, shape):
+        self.shape = shape
+
+    def init(self):
+        self.frame = None if self.shape is None else np.zeros(self.shape, dtype=np.uint8)
+
+    def __call__(self, n, *shms):
+        for i in range(n):
+            t0 = time.monotonic()
+            if self.frame is None:
+                yield {'t0': t0}
+            elif isinstance(shms[0], ShmRing):
+                idx = shms[0].write(self.frame)
+                yield {'t0': t0, 'slot': idx, 'seq': shms[0].seq(idx)}
+            else:
+                shms[0].lock()
+                shms[0].data = self.frame
+                yield {'t0': t0}
+        yield State.STOP
+
+
+def shm_passthrough(x, *shms):
+    if len(shms) == 0:
+        return x
+    src, dst = shms
+    if isinstance(src, ShmRing):
+        idx = dst.write(src.read(x['slot'], x['seq']))
+        src.release(x['slot'])
+        return {'t0': x['t0'], 'slot': idx, 'seq': dst.seq(idx)}
+    dst.lock()
+    dst.data = src.data
+    src.unlock()
+    return x
+
+
+class ShmSink(ICallable):
+    # run() of TaskPipelineV2 drops the outputs, the timings go back through a queue on shutdown
+    def __init__(self, results):
+        self.results = results
+        self.times = []
+
+    def __call__(self, x, *shms):
+        if len(shms) > 0 and isinstance(shms[0], ShmRing):
+            shms[0].release(x['slot'])
+        elif len(shms) > 0:
+            shms[0].unlock()
+        self.times.append((x['t0'], time.monotonic()))
+
+    def shutdown(self):
+        self.results.put(self.times)
+
+
+def make_shm(transport, shape, queue_size):
+    if shape is None:
+        return []
+    if transport == 'ring':
+        return [ShmRing(np.uint8, shape, slots=queue_size)]
+    if transport == 'spsc':
+        return [ShmSpsc(np.uint8, shape, slots=queue_size)]
+    return [ShmNumpy('B', shape)]
+
+
+def run_v1(transport, shape, stages, fan_out, queue_size, items, warmup):
+    pipe = TaskPipeline(persistent=True, shm_threshold=1 if transport == 'queue+shm' else None)
+    pipe.add(Source(shape), queue_size=queue_size)
+    for i in range(stages):
+        pipe.add(passthrough, fan_out=fan_out, queue_size=queue_size)
+    pipe.add(sink, queue_size=queue_size)
+    with pipe:
+        list(pipe.stream(warmup))
+        return list(pipe.stream(items, prefetch=items))
+
+
+def run_v2(transport, shape, stages, queue_size, items):
+    results = Queue()
+    shms = []
+    pipe = TaskPipelineV2()
+    shms.extend(make_shm(transport, shape, queue_size))
+    pipe.add(ShmSource(shape), shms=shms[-1:])
+    for i in range(stages):
+        shms.extend(make_shm(transport, shape, queue_size))
+        pipe.add(shm_passthrough, shms=shms[-1:])
+    pipe.add(ShmSink(results))
+    pipe.run(items)
+    times = results.get()
+    # the first stage is still waiting for its next input, close() stops it and releases the shms
+    pipe.close(timeout=5)
+    return times
+
+
+def run_case(transport, payload, stages=1, fan_out=1, queue_size=1, items=200, warmup=10):
+    shape = PAYLOADS[payload]
+    if transport in ('queue', 'queue+shm'):
+        times = run_v1(transport, shape, stages, fan_out, queue_size, items, warmup)
+    else:
+        assert fan_out == 1, 'TaskPipelineV2 stages have a single worker'
+        times = run_v2(transport, shape, stages, queue_size, items)
+
+    latency = np.array([t1 - t0 for t0, t1 in times]) * 1000
+    done = sorted(t1 for _, t1 in times)
+    nbytes = 0 if shape is None else int(np.prod(shape))
+    return {
+        'transport': transport, 'payload': payload, 'stages': stages, 'fan_out': fan_out,
+        'queue_size': queue_size, 'items': len(times),
+        'items_per_s': (len(done) - 1) / (done[-1] - done[0]) if len(done) > 1 and done[-1] > done[0] else 0.0,
+        'p50_ms': float(np.percentile(latency, 50)),
+        'p95_ms': float(np.percentile(latency, 95)),
+        'p99_ms': float(np.percentile(latency, 99)),
+        'bytes_copied': COPIES[transport] * nbytes * (stages + 1),
+    }
+
+
+def table(rows):
+    headers = ['transport', 'payload', 'stages', 'fan_out', 'queue_size', 'items/s', 'p50(ms)', 'p95(ms)', 'p99(ms)',
+            'copied/item']
+    lines = ['|'.join(headers), '|'.join(['---'] * len(headers))]
+    for y in rows:
+        lines.append('|'.join([
+            y['transport'], y['payload'], str(y['stages']), str(y['fan_out']), str(y['queue_size']),
+            '%.1f' % y['items_per_s'], '%.2f' % y['p50_ms'], '%.2f' % y['p95_ms'], '%.2f' % y['p99_ms'],
+            '%.1fMB' % (y['bytes_copied'] / 1e6)]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='easy_task transport and pipeline benchmark')
+    parser.add_argument('--transports', nargs='+', default=list(TRANSPORTS), choices=TRANSPORTS)
+    parser.add_argument('--payloads', nargs='+', default=list(PAYLOADS), choices=list(PAYLOADS))
+    parser.add_argument('--stages', nargs='+', type=int, default=[1])
+    parser.add_argument('--fan-out', nargs='+', type=int, default=[1])
+    parser.add_argument('--queue-size', nargs='+', type=int, default=[1])
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--json', help='also write the rows to this file')
+    args = parser.parse_args()
+
+    rows = []
+    for transport, payload, stages, fan_out, queue_size in itertools.product(
+            args.transports, args.payloads, args.stages, args.fan_out, args.queue_size):
+        if fan_out > 1 and transport not in ('queue', 'queue+shm'):
+            continue
+        rows.append(run_case(transport, payload, stages, fan_out, queue_size, args.items))
+        print(table(rows[-1:]).split('\n')[-1], flush=True)
+
+    print()
+    print(table(rows))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,13 @@
 # @date 2022-02-17 21:34
 
 
-import abc, sys
+import abc, sys, os
 import threading
+import heapq
+import time
 
 from multiprocessing import Queue
-from queue import Empty
+from queue import Empty, SimpleQueue
 from enum import IntEnum, unique
 
 
@@ -36,19 +38,145 @@ class MessageType(IntEnum):
 
 
 class Message(object):
+    __slots__ = ('what', 'arg1', 'arg2', 'obj')
+    # recycled messages, bounded like the android.os.Message pool, list append and pop hold the GIL
+    pool = []
+    MAX_POOL = 64
+
     def __init__(self, what, arg1, arg2, obj):
         self.what = what
         self.arg1 = arg1
         self.arg2 = arg2
         self.obj = obj
 
+    def __reduce__(self):
+        return (Message, self.astuple())
+
+    def astuple(self):
+        return (self.what, self.arg1, self.arg2, self.obj)
+
     def __str__(self):
         obj = self.obj[:32] if isinstance(self.obj, str) else self.obj.__class__.__name__
         return f'Message({self.what}, {self.arg1}, {self.arg2}, {obj})'
 
     @staticmethod
     def obtain(what, arg1, arg2, obj):
-        return Message(what, arg1, arg2, obj)
+        try:
+            msg = Message.pool.pop()
+        except IndexError:
+            return Message(what, arg1, arg2, obj)
+        msg.what, msg.arg1, msg.arg2, msg.obj = what, arg1, arg2, obj
+        return msg
+
+    def recycle(self):
+        # the message must not be used after this, obj is dropped so the pool holds no payload
+        self.obj = None
+        if len(Message.pool) < Message.MAX_POOL:
+            Message.pool.append(self)
+
+
+@unique
+class Coalesce(IntEnum):
+    KEEP_ALL = 0
+    KEEP_LATEST = 1
+
+
+class MessageQueue(object):
+    # threads of the looper process put to a SimpleQueue without pickling, other processes put to a
+    # multiprocessing Queue that a bridge thread forwards once the queue has been shared by fork or pickle,
+    # scheduled messages wait in a heap of (when, seq, message tuple, period) until they are due
+    def __init__(self):
+        self.pid = os.getpid()
+        self.local = SimpleQueue()
+        self.remote = Queue()
+        self.bridge = None
+        self.timers = []
+        self.seq = 0
+        self.lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_parent=self.share)
+
+    def __getstate__(self):
+        self.share()
+        return {'pid': self.pid, 'remote': self.remote}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local, self.bridge = None, None
+
+    def share(self):
+        if self.bridge is None and os.getpid() == self.pid:
+            self.bridge = threading.Thread(target=self.forward, name='MessageBridge', daemon=True)
+            self.bridge.start()
+
+    def forward(self):
+        # (what,) removes, (what, arg1, arg2, obj) is sent now and with (when, period) it is scheduled
+        while True:
+            x = self.remote.get()
+            if len(x) == 1:
+                self.remove(x[0])
+            else:
+                self.put(Message.obtain(*x[:4]), *x[4:])
+
+    def put(self, msg, when=None, period=None):
+        if os.getpid() != self.pid:
+            # a tuple is pickled by the feeder thread later, so the message goes back to the pool right away
+            self.remote.put(msg.astuple() if when is None else msg.astuple() + (when, period))
+            msg.recycle()
+            return
+        if when is None:
+            self.local.put(msg)
+            return
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.timers, (when, self.seq, msg.astuple(), period))
+            first = self.timers[0][1] == self.seq
+        msg.recycle()
+        if first:
+            # the looper sleeps until the earliest due time, None wakes it to wait for the new one
+            self.local.put(None)
+
+    def remove(self, what):
+        if os.getpid() != self.pid:
+            self.remote.put((what,))
+            return
+        with self.lock:
+            self.timers = [x for x in self.timers if x[2][0] != what]
+            heapq.heapify(self.timers)
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if len(self.timers) > 0 and self.timers[0][0] <= now:
+                    when, seq, args, period = heapq.heappop(self.timers)
+                    if period is not None:
+                        # a looper that fell behind skips the missed repeats
+                        when = when + period if when + period > now else now + period
+                        heapq.heappush(self.timers, (when, seq, args, period))
+                    return Message.obtain(*args)
+                wait = self.timers[0][0] - now if len(self.timers) > 0 else None
+            if deadline is not None:
+                wait = max(0, deadline - now) if wait is None else max(0, min(wait, deadline - now))
+            try:
+                msg = self.local.get(timeout=wait)
+            except Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                continue
+            if msg is not None:
+                return msg
+
+    def drain(self, limit=1024):
+        # the next message and everything else queued or due right now, so a burst is handled as one batch
+        batch = [self.get()]
+        while len(batch) < limit:
+            try:
+                batch.append(self.get(timeout=0))
+            except Empty:
+                break
+        return batch
 
 
 class MessageHandler(metaclass=abc.ABCMeta):
@@ -66,6 +194,25 @@ class MessageHandler(metaclass=abc.ABCMeta):
             self.mq.put(msg)
         return True
 
+    def send_message_at_time(self, what, when, arg1=-1, arg2=-1, obj=None, period=None):
+        # when: time.monotonic() of the dispatch, period: seconds between repeats until remove_messages(what)
+        if self.mq:
+            msg = Message.obtain(what, arg1, arg2, obj)
+            self.mq.put(msg, when, period)
+        return True
+
+    def send_message_delayed(self, what, delay, arg1=-1, arg2=-1, obj=None):
+        return self.send_message_at_time(what, time.monotonic() + delay, arg1, arg2, obj)
+
+    def send_message_periodic(self, what, period, arg1=-1, arg2=-1, obj=None, delay=None):
+        when = time.monotonic() + (period if delay is None else delay)
+        return self.send_message_at_time(what, when, arg1, arg2, obj, period)
+
+    def remove_messages(self, what):
+        # drops the scheduled messages of what, the ones already due are on their way
+        if self.mq:
+            self.mq.remove(what)
+
     def dispatch_message(self, msg):
         try:
             return self.handle_message(msg.what, msg.arg1, msg.arg2, msg.obj)
@@ -82,13 +229,37 @@ class DefaultHandler(MessageHandler):
         return False
 
 
+class Dispatcher(threading.Thread):
+    # one lane of the MainLooper dispatch pool, runs the messages routed to it in order
+    def __init__(self, looper, index):
+        super(Dispatcher, self).__init__(name=f'MessageDispatcher-{index}', daemon=True)
+        self.looper = looper
+        self.mq = SimpleQueue()
+        self.load = 0
+
+    def run(self):
+        while True:
+            msg = self.mq.get()
+            if msg is None:
+                break
+            what = msg.what
+            self.looper.dispatch(msg)
+            self.looper.done(self, what)
+
+
 class MainLooper(threading.Thread, metaclass=SingletonType):
 
-    def __init__(self):
+    def __init__(self, workers=1):
+        # workers: dispatch threads, messages of one what stay in order and different ones run side by side
         super(MainLooper, self).__init__(name='MainLooper')
-        self.mq = Queue()
+        self.mq = MessageQueue()
         self.handlers = {}
         self.H = DefaultHandler(self.mq)
+        self.workers = workers
+        self.lanes = []
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.policies = {}
 
     @property
     def default_handler(self):
@@ -101,19 +272,80 @@ class MainLooper(threading.Thread, metaclass=SingletonType):
                 self.handlers[ty] = []
             self.handlers[ty].append(handler)
 
+    def set_coalescing(self, what, policy=Coalesce.KEEP_LATEST, key=None):
+        # policy: Coalesce or merge(old_obj, new_obj) returning the obj the latest message carries on,
+        # key: groups the messages of what that coalesce, e.g. lambda msg: msg.arg1, all of them by default
+        if policy == Coalesce.KEEP_ALL:
+            self.policies.pop(what, None)
+        else:
+            self.policies[what] = (None if policy == Coalesce.KEEP_LATEST else policy, key)
+
+    def coalesce(self, batch):
+        # the latest message of a group stays where it arrived, so the survivors keep their arrival order,
+        # the older ones go back to the pool
+        if len(batch) == 1 or len(self.policies) == 0:
+            return batch
+        out, slots = [], {}
+        for msg in batch:
+            policy = self.policies.get(msg.what)
+            if policy is not None:
+                merge, key = policy
+                group = (msg.what, None if key is None else key(msg))
+                i = slots.get(group)
+                if i is not None:
+                    old, out[i] = out[i], None
+                    if merge is not None:
+                        msg.obj = merge(old.obj, msg.obj)
+                    old.recycle()
+                slots[group] = len(out)
+            out.append(msg)
+        return [msg for msg in out if msg is not None]
+
+    def dispatch(self, msg):
+        for handler in self.handlers.get(msg.what, []):
+            if handler.dispatch_message(msg):
+                break
+        msg.recycle()
+
+    def route(self, msg):
+        # a what keeps its lane while messages of it wait there, an idle one goes to the least loaded lane
+        with self.lock:
+            entry = self.keys.get(msg.what)
+            if entry is None:
+                entry = self.keys[msg.what] = [min(self.lanes, key=lambda lane: lane.load), 0]
+            entry[1] += 1
+            entry[0].load += 1
+        entry[0].mq.put(msg)
+
+    def done(self, lane, what):
+        with self.lock:
+            lane.load -= 1
+            entry = self.keys[what]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.keys[what]
+
     def run(self):
-        while True:
-            try:
-                msg = self.mq.get(timeout=3)
-                if msg.what == MessageType.QUIT:
-                    break
-                if msg.what not in self.handlers:
-                    continue
-                for handler in self.handlers[msg.what]:
-                    if handler.dispatch_message(msg):
-                        break
-            except Empty:
-                pass
+        if self.workers > 1:
+            self.lanes = [Dispatcher(self, i) for i in range(self.workers)]
+            for lane in self.lanes:
+                lane.start()
+        quit = False
+        while not quit:
+            # sleeps until the next message or the next scheduled one is due, then takes all that are waiting
+            for msg in self.coalesce(self.mq.drain()):
+                if quit:
+                    msg.recycle()
+                elif msg.what == MessageType.QUIT:
+                    quit = True
+                elif len(self.lanes) > 0:
+                    self.route(msg)
+                else:
+                    self.dispatch(msg)
+        for lane in self.lanes:
+            lane.mq.put(None)
+        for lane in self.lanes:
+            lane.join()
 
 # MessageHandler.logger = nbeasy_get_logger('nbeasy')
 # @unique
@@ -163,8 +395,12 @@ class MainLooper(threading.Thread, metaclass=SingletonType):
 #
 #         return False
 #
-# main_loop = MainLooper()
+# main_loop = MainLooper(workers=2)
 # main_loop.add_handler(ServiceStateMessageHandler())
+# main_loop.set_coalescing(MessageType.STATE, Coalesce.KEEP_LATEST, key=lambda msg: msg.arg1)
+# main_loop.set_coalescing(MessageType.LOG, lambda old, new: f'{old}\n{new}')
 # main_loop.start()
 # main_loop.default_handler.send_message(MessageType.STATE, ServiceType.APP, StateType.RUNNING, 'test')
+# main_loop.default_handler.send_message_periodic(MessageType.STATE, 1.0, ServiceType.SRS, StateType.RUNNING)
+# main_loop.default_handler.send_message_delayed(MessageType.QUIT, 5.0)
 # main_loop.join()
@@ -1,18 +1,45 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from multiprocessing import Process, Queue, Value, Array, Pipe, Lock
-from enum import Enum
+from multiprocessing import Process, Queue, Value, Array, Pipe, Lock, Semaphore, Condition
+from multiprocessing import shared_memory, resource_tracker, AuthenticationError
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import Future
+from queue import Empty, Full, Queue as ThreadQueue
+from collections import deque
+from enum import Enum, IntEnum
+from fractions import Fraction
 from abc import ABC, abstractmethod
 import numpy as np
+import threading
+import asyncio
 import inspect
+import weakref
+import ctypes
+import traceback
+import time
+import copy
+import os
 import sys # noqa
 
 
 class State(Enum):
     STOP = "S_STOP"
     SHUTDOWN = "S_SHUTDOWN"
-    SHUTDOWN_LAST = "S_SHUTDOWN_LAST"
+    CLOSE = "S_CLOSE"
+    RETIRE = "S_RETIRE"
+
+
+class TaskError(Exception):
+    # raised in the parent when a worker failed and its stage ran out of restarts
+    def __init__(self, id, stage, name, error, trace=None, items=None):
+        super().__init__(id, stage, name, error, trace, items)
+        self.id, self.stage, self.name = id, stage, name
+        self.error, self.trace, self.items = error, trace, items
+
+    def __str__(self):
+        msg = 'task {} (stage {}: {}) failed: {}'.format(self.id, self.stage, self.name, self.error)
+        return msg if self.trace is None else '{}\n{}'.format(msg, self.trace)
 
 
 class ICallable(ABC):
@@ -30,89 +57,1667 @@ class ICallable(ABC):
         pass
 
 
+class Policy(Enum):
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    SAMPLE = "sample"
+
+
+class Executor(Enum):
+    PROCESS = "process"
+    THREAD = "thread"
+    ASYNC = "async"
+
+
+class Cancel(IntEnum):
+    # TaskPipeline.cancel, the run is cut short and its STOP is already submitted or comes from the source
+    # of the first stage
+    NONE = 0
+    SUBMITTED = 1
+    SOURCE = 2
+
+
+class ShmHandle(object):
+    # an array parked in its own shared memory block, only name, dtype and shape cross the queue,
+    # the consumer unlinks the block on open and unmaps it once the last view of the array is gone
+    closing = []
+
+    def __init__(self, d):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, d.nbytes))
+        np.ndarray(d.shape, d.dtype, buffer=shm.buf)[...] = d
+        # the consumer owns the block from here on
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        self.name, self.dtype, self.shape = shm.name, d.dtype.str, d.shape
+        shm.close()
+
+    def open(self):
+        ShmHandle.reap()
+        shm = shared_memory.SharedMemory(name=self.name)
+        shm.unlink()
+        # numpy keeps the ctypes view as base, so it dies with the last array view
+        buf = (ctypes.c_char * shm.size).from_buffer(shm.buf)
+        weakref.finalize(buf, ShmHandle.closing.append, shm).atexit = False
+        return np.ndarray(self.shape, self.dtype, buffer=buf)
+
+    def discard(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        shm.close()
+        shm.unlink()
+
+    @staticmethod
+    def reap():
+        # the finalizer runs before the view releases its buffer, so blocks are closed on the next call
+        for shm in ShmHandle.closing[:]:
+            try:
+                shm.close()
+                ShmHandle.closing.remove(shm)
+            except BufferError:
+                pass
+
+    @staticmethod
+    def pack(x, threshold):
+        if isinstance(x, np.ndarray):
+            return ShmHandle(x) if x.nbytes >= threshold and not x.dtype.hasobject else x
+        if isinstance(x, Keyed):
+            return Keyed(x.seq, x.credit, ShmHandle.pack(x.value, threshold), x.empty)
+        if isinstance(x, Prioritized):
+            return Prioritized(ShmHandle.pack(x.value, threshold), x.priority, x.deadline)
+        if type(x) in (list, tuple):
+            return type(x)(ShmHandle.pack(y, threshold) for y in x)
+        if type(x) is dict:
+            return {k: ShmHandle.pack(y, threshold) for k, y in x.items()}
+        return x
+
+    @staticmethod
+    def unpack(x, discard=False):
+        if isinstance(x, ShmHandle):
+            return x.discard() if discard else x.open()
+        if isinstance(x, Keyed):
+            return Keyed(x.seq, x.credit, ShmHandle.unpack(x.value, discard), x.empty)
+        if isinstance(x, Prioritized):
+            return Prioritized(ShmHandle.unpack(x.value, discard), x.priority, x.deadline)
+        if type(x) in (list, tuple):
+            return type(x)(ShmHandle.unpack(y, discard) for y in x)
+        if type(x) is dict:
+            return {k: ShmHandle.unpack(y, discard) for k, y in x.items()}
+        return x
+
+
+class Keyed(object):
+    # item of a checkpointed run, credit is its share of input seq, an empty one only hands back the share
+    # of an item that had no outputs
+    def __init__(self, seq, credit, value=None, empty=False):
+        self.seq = seq
+        self.credit = credit
+        self.value = value
+        self.empty = empty
+
+
+class Prioritized(object):
+    # item of a priority class, deadline is a time.monotonic() past which the stages drop it,
+    # its outputs inherit both
+    def __init__(self, value, priority=0, deadline=None):
+        self.value = value
+        self.priority = priority
+        self.deadline = deadline
+
+
+class Checkpoint(object):
+    # durable progress log of long runs, completed input seqs are appended one line per batch with a single
+    # fsync, a rerun with the same log skips the seqs it lists
+    def __init__(self, path, flush_every=256, flush_interval=5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    # the last line of a killed run may be torn
+                    if line.endswith('\n'):
+                        self.done.update(int(x) for x in line.split())
+        self.seq = Value('Q', 0)
+        self.credits = {}
+        self.pending = []
+        self.flushed = time.monotonic()
+
+    def take(self):
+        # next input seq, None when an earlier run completed it
+        with self.seq.get_lock():
+            seq = self.seq.value
+            self.seq.value += 1
+        return None if seq in self.done else seq
+
+    def credit(self, seq, credit):
+        total = self.credits.pop(seq, 0) + credit
+        if total < 1:
+            self.credits[seq] = total
+            return
+        self.done.add(seq)
+        self.pending.append(seq)
+        if len(self.pending) >= self.flush_every or time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            with open(self.path, 'a') as f:
+                f.write(' '.join(str(seq) for seq in self.pending) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+        self.flushed = time.monotonic()
+
+
+def is_local(q):
+    return isinstance(q, ThreadQueue) or getattr(q, 'local', False)
+
+
+class StageQueue(object):
+    # bounded stage input queue, the overflow policy is applied on the producer side, sentinels always block
+    def __init__(self, maxsize=1, policy=Policy.BLOCK, sample_every=1, ordered=False, window=0, local=False,
+            workers=1, priorities=1):
+        # local: producers and consumers are all threads of the parent, no pickling needed
+        self.queue = ThreadQueue(maxsize) if local else Queue(maxsize)
+        # priorities: one queue per class, plain items and sentinels go to class 0 and the highest waiting
+        # class is taken first, items counts all of them
+        self.queues = [self.queue] + [ThreadQueue(maxsize) if local else Queue(maxsize) for i in range(priorities - 1)]
+        self.items = None
+        if priorities > 1:
+            self.items = threading.Semaphore(0) if local else Semaphore(0)
+        self.local = local
+        self.tagged = False
+        # the stage workers count themselves here, so sentinels work for any number of them
+        self.cond = Condition()
+        self.live = Value('i', workers, lock=False)
+        self.arrived = Value('i', 0, lock=False)
+        self.generation = Value('Q', 0, lock=False)
+        self.maxsize = maxsize
+        self.policy = Policy(policy)
+        assert self.items is None or self.policy != Policy.DROP_OLDEST, 'priority classes drop the newest items'
+        self.sample_every = max(1, sample_every)
+        self.count = 0
+        self.dropped = 0
+        self.ordered = ordered
+        if ordered:
+            # items are tagged (seq, x) when taken, so dropped items never leave a gap in the sequence
+            self.lock = Lock()
+            self.seq = Value('Q', 0, lock=False)
+            self.window = Semaphore(window) if window > 0 else None
+
+    def take(self, block=True, timeout=None):
+        if self.items is None:
+            return self.queue.get(block, timeout)
+        if not self.items.acquire(block, timeout):
+            raise Empty
+        while True:
+            for queue in reversed(self.queues):
+                try:
+                    return queue.get_nowait()
+                except Empty:
+                    pass
+            # counted but still in the feeder thread of the producer
+            time.sleep(0)
+
+    def push(self, queue, x, block=True):
+        queue.put(x, block)
+        if self.items is not None:
+            self.items.release()
+
+    def get(self, block=True, timeout=None):
+        if not self.ordered:
+            return self.take(block, timeout)
+
+        if self.window is not None and not self.window.acquire(block, timeout):
+            raise Empty
+        try:
+            with self.lock:
+                x = self.take(block, timeout)
+                if isinstance(x, State):
+                    self.release()
+                    return x
+                seq = self.seq.value
+                self.seq.value += 1
+            return seq, x
+        except Empty:
+            self.release()
+            raise
+
+    def release(self):
+        if self.window is not None:
+            self.window.release()
+
+    def put(self, x):
+        queue = self.queue
+        if isinstance(x, Prioritized) and self.items is not None:
+            queue = self.queues[min(max(x.priority, 0), len(self.queues) - 1)]
+        if isinstance(x, State) or self.policy == Policy.BLOCK:
+            self.push(queue, x)
+            return
+
+        if self.policy == Policy.SAMPLE:
+            self.count += 1
+            if (self.count - 1) % self.sample_every == 0:
+                self.push(queue, x)
+            else:
+                self.drop(x)
+            return
+
+        while True:
+            try:
+                self.push(queue, x, False)
+                return
+            except Full:
+                if self.policy == Policy.DROP_NEWEST:
+                    self.drop(x)
+                    return
+            # drop the oldest and retry, a data item never waits on a full queue
+            try:
+                y = self.queue.get_nowait()
+            except Empty:
+                # full and empty at once, the oldest is still in the feeder thread of its producer
+                time.sleep(0)
+                continue
+            if isinstance(y, State):
+                self.queue.put(y)
+            else:
+                self.drop(y)
+
+    def enter(self):
+        # a new worker only joins a stage whose run has not ended yet
+        with self.cond:
+            if self.live.value == 0:
+                return False
+            self.live.value += 1
+            return True
+
+    def leave(self):
+        # True for the last worker out, which passes the sentinel downstream
+        with self.cond:
+            self.live.value -= 1
+            return self.live.value == 0
+
+    def retire(self):
+        # the last worker and the workers of a stage that is ending keep running
+        with self.cond:
+            if self.live.value <= 1 or self.arrived.value > 0:
+                return False
+            self.live.value -= 1
+            return True
+
+    def arrive(self):
+        # end of a persistent run, True for the last worker to arrive, the others hand STOP on and wait for it
+        with self.cond:
+            self.arrived.value += 1
+            if self.arrived.value >= self.live.value:
+                self.arrived.value = 0
+                self.generation.value += 1
+                self.cond.notify_all()
+                return True
+            generation = self.generation.value
+        self.put(State.STOP)
+        with self.cond:
+            self.cond.wait_for(lambda: self.generation.value != generation)
+        return False
+
+    def drop(self, x):
+        self.dropped += 1
+        if not self.local:
+            ShmHandle.unpack(x, discard=True)
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def empty(self):
+        return all(queue.empty() for queue in self.queues)
+
+
+class TaskStats(object):
+    # per worker counters, snapshots are pushed to the parent every interval seconds and on exit,
+    # twice per scaler step so every step sees a fresh one
+    def __init__(self, id, stage, name, interval=0.5, samples=1024):
+        self.id, self.stage, self.name = id, stage, name
+        self.items_in, self.items_out = 0, 0
+        self.busy, self.get_wait, self.put_wait = 0.0, 0.0, 0.0
+        self.expired = 0
+        self.occupancy = {}
+        self.latency = deque(maxlen=samples)
+        self.interval = interval
+        self.last_report = time.monotonic()
+
+    def sample_queue(self, q):
+        try:
+            self.sample(q.qsize())
+        except (NotImplementedError, AttributeError):
+            pass
+
+    def sample(self, n):
+        self.occupancy[n] = self.occupancy.get(n, 0) + 1
+
+    def snapshot(self):
+        return {
+            'id': self.id, 'stage': self.stage, 'name': self.name,
+            'items_in': self.items_in, 'items_out': self.items_out,
+            'busy': self.busy, 'get_wait': self.get_wait, 'put_wait': self.put_wait, 'expired': self.expired,
+            'occupancy': dict(self.occupancy), 'latency': list(self.latency),
+        }
+
+    def report(self, stats_queue, force=False):
+        now = time.monotonic()
+        if stats_queue is None or (not force and now - self.last_report < self.interval):
+            return
+        self.last_report = now
+        x = self.snapshot()
+        # a forced report ends a run or the worker, the parent waits for it by its time
+        x['time'], x['final'] = now, now if force else None
+        stats_queue.put(x)
+
+
+class StatsCollector(object):
+    # parent side of TaskStats, keeps the latest snapshot of every worker and merges them by stage
+    def __init__(self):
+        self.queue = Queue()
+        self.snapshots = {}
+        self.final = {}
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.closed = False
+        self.reader = None
+
+    def start(self):
+        # a worker blocks on exit until its snapshots are out of the pipe, so they are read as they come
+        # while the workers run
+        if self.reader is None and not self.closed:
+            self.reader = threading.Thread(target=self.read, name='TaskStatsReader', daemon=True)
+            self.reader.start()
+
+    def stop(self):
+        # the reader ends on None, the snapshots it has read stay available and start() reads on
+        if self.reader is not None:
+            self.queue.put(None)
+            self.reader.join(1)
+            self.reader = None
+
+    def read(self):
+        while True:
+            try:
+                x = self.queue.get()
+            except (EOFError, OSError, TypeError):
+                # the queue is closed under the thread at interpreter exit
+                break
+            if x is None:
+                break
+            with self.cond:
+                self.store(x)
+
+    def store(self, x):
+        self.snapshots[x['id']] = x
+        if x['final'] is not None:
+            self.final[x['id']] = x['final']
+            self.cond.notify_all()
+
+    def wait(self, tasks, since=0.0, timeout=1.0):
+        # the final snapshots travel on another queue than the sentinel of the run, stats() right after it
+        # has the ones these tasks forced after since, or after they started
+        with self.cond:
+            self.cond.wait_for(lambda: all(
+                self.final.get(task.id, -1) >= max(since, task.started) for task in tasks), timeout)
+
+    def collect(self):
+        with self.lock:
+            return self.merge()
+
+    def close(self):
+        if self.closed:
+            return
+        self.stop()
+        self.queue.close()
+        self.closed = True
+
+    def merge(self):
+        while not self.closed:
+            try:
+                x = self.queue.get_nowait()
+            except Empty:
+                break
+            self.store(x)
+
+        stages = {}
+        for x in sorted(self.snapshots.values(), key=lambda x: (x['stage'], x['id'])):
+            key = '{}:{}'.format(x['stage'], x['name'])
+            if key not in stages:
+                stages[key] = {
+                    'workers': 0, 'items_in': 0, 'items_out': 0,
+                    'busy': 0.0, 'get_wait': 0.0, 'put_wait': 0.0, 'expired': 0,
+                    'occupancy': {}, 'latency': []}
+            y = stages[key]
+            y['workers'] += 1
+            for k in ('items_in', 'items_out', 'busy', 'get_wait', 'put_wait', 'expired'):
+                y[k] += x[k]
+            for n, c in x['occupancy'].items():
+                y['occupancy'][n] = y['occupancy'].get(n, 0) + c
+            y['latency'].extend(x['latency'])
+
+        for y in stages.values():
+            latency = y.pop('latency')
+            for p in (50, 95, 99):
+                y['p{}_ms'.format(p)] = float(np.percentile(latency, p)) * 1000 if latency else 0.0
+        return stages
+
+    def table(self):
+        stages = self.collect()
+        headers = ['stage', 'workers', 'in', 'out', 'busy(s)', 'get_wait(s)', 'put_wait(s)', 'p50(ms)', 'p95(ms)', 'p99(ms)']
+        lines = ['|'.join(headers), '|'.join(['---'] * len(headers))]
+        for key, y in stages.items():
+            lines.append('|'.join([
+                key, str(y['workers']), str(y['items_in']), str(y['items_out']),
+                '%.3f' % y['busy'], '%.3f' % y['get_wait'], '%.3f' % y['put_wait'],
+                '%.2f' % y['p50_ms'], '%.2f' % y['p95_ms'], '%.2f' % y['p99_ms']]))
+        return '\n'.join(lines)
+
+    def show(self, alive=None, interval=None):
+        from IPython.display import Markdown, display
+        handle = display(Markdown(self.table()), display_id=True)
+        if interval is None or alive is None:
+            return
+
+        def _update():
+            while alive():
+                time.sleep(interval)
+                handle.update(Markdown(self.table()))
+            handle.update(Markdown(self.table()))
+
+        threading.Thread(target=_update, name='TaskStats', daemon=True).start()
+
+
+class Reorder(ICallable):
+    # fan-in stage of an ordered fan-out, buffers (seq, outputs) until the next expected seq arrives
+    def __init__(self, input_queue):
+        self.input_queue = input_queue
+        self.next_seq = 0
+        self.pending = {}
+
+    def __call__(self, x):
+        seq, outputs = x
+        self.pending[seq] = outputs
+        while self.next_seq in self.pending:
+            for y in self.pending.pop(self.next_seq):
+                yield y
+            self.next_seq += 1
+            self.input_queue.release()
+
+
+class Supervisor(object):
+    # parent side watchdog, restarts dead workers within a retry budget and raises TaskError past it
+    def __init__(self, retries=0, requeue=False, timeout=None, interval=0.5):
+        self.queue = Queue()
+        self.retries = retries
+        self.requeue = requeue
+        self.timeout = timeout
+        self.interval = interval
+        self.restarts = {}
+        self.failures = {}
+
+    def close(self):
+        self.queue.close()
+
+    def check(self, tasks):
+        # a worker reports before it exits, so reading the reports after the liveness check never misses one
+        dead = [task for task in tasks if getattr(task, 'process', None) is not None and not task.process.is_alive()]
+        while True:
+            try:
+                error = self.queue.get_nowait()
+            except Empty:
+                break
+            self.failures[error.id] = error
+
+        for task in dead:
+            process = task.process
+            error = self.failures.pop(task.id, None)
+            if error is None:
+                # threads always report, a process that died without a report was killed or crashed
+                exitcode = getattr(process, 'exitcode', None)
+                if not exitcode:
+                    continue
+                error = TaskError(task.id, task.stage, task.name, 'exit code {}'.format(exitcode))
+            n = self.restarts.get(task.id, 0)
+            if n >= self.retries:
+                raise error
+            self.restarts[task.id] = n + 1
+            sys.stderr.write('restart task {} ({}/{}): {}\n'.format(task.id, n + 1, self.retries, error.error))
+            task.recover(error, self.requeue)
+            task.start()
+
+
+class Placement(object):
+    # cpu set and thread cap of a worker, applied inside it before fn.init(),
+    # a numa node narrows cpus to that node, its memory follows by first touch
+    THREAD_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+    def __init__(self, cpus=None, numa_node=None, threads=None):
+        if numa_node is not None:
+            node = Placement.node_cpus(numa_node)
+            cpus = node if cpus is None else [x for x in cpus if x in node]
+            assert len(cpus) > 0, 'no cpu of numa node {} left'.format(numa_node)
+        self.cpus = None if cpus is None else sorted(cpus)
+        self.threads = threads
+
+    @staticmethod
+    def node_cpus(node):
+        with open('/sys/devices/system/node/node{}/cpulist'.format(node)) as f:
+            cpus = []
+            for x in f.read().strip().split(','):
+                lo, _, hi = x.partition('-')
+                cpus.extend(range(int(lo), int(hi or lo) + 1))
+            return cpus
+
+    def apply(self, process=True):
+        # pid 0 is the calling thread on linux, a thread worker only pins itself
+        if self.cpus is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cpus)
+        if self.threads is None or not process:
+            return
+        for key in self.THREAD_ENV:
+            os.environ[key] = str(self.threads)
+        # pools the parent already started under fork ignore the environment
+        try:
+            from threadpoolctl import threadpool_limits
+            self.limits = threadpool_limits(self.threads)
+        except ImportError:
+            pass
+        if 'cv2' in sys.modules:
+            sys.modules['cv2'].setNumThreads(self.threads)
+        if 'torch' in sys.modules:
+            sys.modules['torch'].set_num_threads(self.threads)
+
+
+class Join(ICallable):
+    # merges the (seq, y) results of several branches into {name: y}, released in seq order
+    def __init__(self, names):
+        self.names = names
+        self.next_seq = 0
+        self.pending = {}
+
+    def __call__(self, x):
+        name, (seq, y) = x
+        self.pending.setdefault(seq, {})[name] = y
+        while len(self.pending.get(self.next_seq, ())) == len(self.names):
+            yield self.pending.pop(self.next_seq)
+            self.next_seq += 1
+
+
+class Branch(object):
+    # output of a stage with several downstream stages, each item is tagged with a seq and sent to all of them,
+    # arrays go to every process queue in their own shm block since each consumer unlinks the one it opens
+    local = True
+
+    def __init__(self, targets, shm_threshold=None):
+        self.targets = targets
+        self.shm_threshold = shm_threshold
+        self.lock = Lock()
+        self.seq = Value('Q', 0, lock=False)
+
+    def put(self, x):
+        if not isinstance(x, State):
+            with self.lock:
+                seq = self.seq.value
+                self.seq.value += 1
+            if isinstance(x, Prioritized):
+                x = Prioritized((seq, x.value), x.priority, x.deadline)
+            else:
+                x = (seq, x)
+        for q in self.targets:
+            if self.shm_threshold is None or is_local(q):
+                q.put(x)
+            else:
+                q.put(ShmHandle.pack(x, self.shm_threshold))
+
+
+class Tag(object):
+    # names the branch an item comes from on the input queue shared by a join
+    def __init__(self, queue, name):
+        self.queue = queue
+        self.name = name
+
+    @property
+    def local(self):
+        return is_local(self.queue)
+
+    def put(self, x):
+        if isinstance(x, Prioritized):
+            x = Prioritized((self.name, x.value), x.priority, x.deadline)
+        elif not isinstance(x, State):
+            x = (self.name, x)
+        self.queue.put(x)
+
+
+class Stage(object):
+    # node of the pipeline graph, outputs holds the input queues of its downstream stages
+    def __init__(self, name, tasks, executor, input_queue, max_workers=None):
+        self.name = name
+        self.tasks = tasks
+        self.executor = executor
+        self.input_queue = input_queue
+        self.outputs = []
+        self.branch = None
+        self.min_workers = len(tasks)
+        self.max_workers = max(max_workers or 0, len(tasks))
+        self.pressure = 0
+
+
+class Scaler(object):
+    # parent side controller of the autoscaled stages, a stage whose input queue stays full while its workers
+    # are busy gets one more, one whose workers idle on an empty queue gives one back
+    def __init__(self, interval=1.0, high=0.8, low=0.3, patience=2):
+        self.interval = interval
+        self.high, self.low = high, low
+        self.patience = patience
+        self.thread = None
+        # time and busy of the last snapshot of every worker the utilization was measured from
+        self.seen = {}
+
+    def start(self, pipeline):
+        # only the running thread holds the pipeline, an idle one is freed with its queues
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, args=(pipeline,), name='TaskScaler', daemon=True)
+            self.thread.start()
+
+    def run(self, pipeline):
+        while pipeline.started:
+            time.sleep(self.interval)
+            self.step(pipeline)
+
+    def step(self, pipeline):
+        pipeline.collector.collect()
+        snapshots = pipeline.collector.snapshots
+        for stage in pipeline.graph:
+            q = stage.input_queue
+            if stage.max_workers <= stage.min_workers or q.live.value == 0:
+                continue
+            try:
+                depth = q.qsize()
+            except NotImplementedError:
+                continue
+            utilization = self.utilization(stage, snapshots)
+            if utilization is None:
+                continue
+            if depth >= q.maxsize and utilization > self.high:
+                stage.pressure = max(stage.pressure, 0) + 1
+            elif depth == 0 and utilization < self.low:
+                stage.pressure = min(stage.pressure, 0) - 1
+            else:
+                stage.pressure = 0
+            if stage.pressure >= self.patience and q.live.value < stage.max_workers:
+                pipeline.grow(stage)
+                stage.pressure = 0
+            elif stage.pressure <= -self.patience and q.live.value > stage.min_workers:
+                q.put(State.RETIRE)
+                stage.pressure = 0
+
+    def utilization(self, stage, snapshots):
+        # mean busy share of the live workers since their previous snapshots or their start, None until every
+        # one of them has reported since the last step, so a new worker or a stale snapshot never counts as idle,
+        # busy excludes the time blocked on put, a stage held up downstream does not grow
+        shares, fresh = [], True
+        for task in stage.tasks:
+            if getattr(task, 'process', None) is None or not task.process.is_alive():
+                continue
+            x = snapshots.get(task.id)
+            last = self.seen.get(task.id)
+            if last is None or last[0] < task.started:
+                last = (task.started, 0.0)
+            if x is None or x['time'] <= last[0]:
+                fresh = False
+                continue
+            shares.append((x['busy'] - last[1]) / (x['time'] - last[0]))
+            self.seen[task.id] = (x['time'], x['busy'])
+        return sum(shares) / len(shares) if fresh and len(shares) > 0 else None
+
+
+class Feed(object):
+    # submitted iterable, the feeder pulls it lazily so the first stage queue bounds the read-ahead
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+
+class Link(object):
+    # broker side of one remote worker connection, batches are numbered so several can be in flight
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.nextId = 0
+        self.alive = True
+        threading.Thread(target=self.read, name='TaskLink', daemon=True).start()
+
+    def submit(self, xs):
+        future = Future()
+        with self.lock:
+            if not self.alive:
+                raise ConnectionError('remote worker is gone')
+            id = self.nextId
+            self.nextId += 1
+            self.pending[id] = future
+            self.conn.send((id, xs))
+        return future
+
+    def read(self):
+        try:
+            while True:
+                id, ys, error = self.conn.recv()
+                with self.lock:
+                    future = self.pending.pop(id)
+                future.set_result((ys, error))
+        except (EOFError, OSError):
+            pass
+        with self.lock:
+            self.alive = False
+            pending, self.pending = list(self.pending.values()), {}
+        for future in pending:
+            future.set_exception(ConnectionError('remote worker is gone'))
+
+    def close(self):
+        # the worker hangs up on None, which ends the reader blocked on this connection
+        with self.lock:
+            if self.alive:
+                self.conn.send(None)
+
+
+class Remote(ICallable):
+    # local broker of a stage that runs on other hosts, workers started there with serve() connect to address
+    # (host, port) or a unix socket path, items go in batches of the stage batch_size, every link pipelines up
+    # to depth batches and the batches of a lost link go to the remaining ones.
+    # the connections unpickle what they receive, so only workers holding authkey get in, a random one is
+    # made when none is given and the caller hands it to serve() on the worker hosts
+    def __init__(self, address, authkey=None, depth=2):
+        self.address = address
+        self.authkey = os.urandom(32) if authkey is None else authkey
+        self.depth = depth
+        self.batched = False
+        self.idle = ThreadQueue()
+        self.links = []
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def init(self):
+        # the stage workers are threads sharing this broker, the links outlive the runs
+        with self.lock:
+            if self.listener is None:
+                self.listener = Listener(self.address, authkey=self.authkey)
+                threading.Thread(target=self.accept, args=(self.listener,), name='TaskRemote', daemon=True).start()
+
+    def accept(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError):
+                # a peer without the key, or one that hung up during the handshake
+                continue
+            except OSError:
+                break
+            if self.listener is not listener:
+                # the wake up call of close()
+                conn.close()
+                break
+            link = Link(conn)
+            self.links.append(link)
+            for i in range(self.depth):
+                self.idle.put(link)
+
+    def __call__(self, x):
+        while True:
+            link = self.idle.get()
+            if not link.alive:
+                continue
+            try:
+                ys, error = link.submit(x if self.batched else [x]).result()
+            except (ConnectionError, OSError):
+                continue
+            self.idle.put(link)
+            if error is not None:
+                raise RuntimeError('remote stage failed\n{}'.format(error))
+            if self.batched:
+                return [y for multi, y in ys for y in (y if multi else [y])]
+            multi, y = ys[0]
+            return (z for z in y) if multi else y
+
+    def close(self):
+        # closing a listener does not wake its accept(), a connection of our own does, the links hang up
+        # their workers and the next init() listens again
+        with self.lock:
+            listener, self.listener = self.listener, None
+        if listener is not None:
+            try:
+                Client(listener.address, authkey=self.authkey).close()
+            except OSError:
+                pass
+            listener.close()
+        for link in self.links:
+            link.close()
+        self.links, self.idle = [], ThreadQueue()
+
+
+def serve(address, fn, authkey):
+    # runs fn for the Remote broker at address until the broker goes away, the next batch is already
+    # on the socket while this one runs, authkey is the one of the Remote
+    conn = Client(address, authkey=authkey)
+    if hasattr(fn, "init"):
+        fn.init()
+    try:
+        while True:
+            try:
+                x = conn.recv()
+            except (EOFError, OSError):
+                break
+            if x is None:
+                break
+            id, xs = x
+            ys, error = [], None
+            try:
+                for x in xs:
+                    y = fn(x)
+                    ys.append((True, list(y)) if inspect.isgenerator(y) else (False, y))
+            except Exception:
+                ys, error = None, traceback.format_exc()
+            conn.send((id, ys, error))
+    finally:
+        conn.close()
+        if hasattr(fn, "shutdown"):
+            fn.shutdown()
+
+
 class Task(object):
-    def __init__(self, id, fn, input_queue, output_queue, multiplicity):
+    def __init__(self, id, fn, input_queue, output_queue, batch_size=1, max_wait_ms=None,
+            ordered=False, executor=Executor.PROCESS, loop=None):
         self.id = id
         self.fn = fn
         self.input_queue = input_queue
         self.output_queue = output_queue
-        self.multiplicity = multiplicity
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.ordered = ordered
+        self.outputs = None
+        self.executor = Executor(executor)
+        self.loop = loop
+        self.stage = 0
+        self.stats = None
+        self.stats_queue = None
+        self.started = 0.0
+        self.cancel = None
+        self.persistent = False
+        self.shm_threshold = None
+        self.errors = None
+        self.current = None
+        self.replay, self.requeue = [], False
+        self.inputs, self.closed = 1, 0
+        self.tagged = False
+        self.placement = None
+        self.checkpoint = None
+        self.priority, self.deadline = None, None
+        self.name = getattr(fn, '__name__', fn.__class__.__name__)
 
     def start(self):
-        self.process = Process(target=self.main_loop, args=(self.input_queue, self.output_queue))
+        # thread and async stages run inside the parent, async ones await fn on the pipeline event loop
+        self.started = time.monotonic()
+        if self.executor == Executor.PROCESS:
+            self.process = Process(target=self.main_loop, args=(self.input_queue, self.output_queue))
+        else:
+            self.process = threading.Thread(target=self.main_loop, args=(self.input_queue, self.output_queue),
+                    name='Task-{}'.format(self.id), daemon=True)
         self.process.start()
 
+    def run_async(self, result):
+        if inspect.iscoroutine(result):
+            return asyncio.run_coroutine_threadsafe(result, self.loop).result()
+        if inspect.isasyncgen(result):
+            return self.iter_async(result)
+        return result
+
+    def iter_async(self, agen):
+        async def anext(agen):
+            return await agen.__anext__()
+
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(anext(agen), self.loop).result()
+            except StopAsyncIteration:
+                break
+
+    def get_item(self, timeout=None):
+        self.stats.sample_queue(self.input_queue)
+        t0 = time.perf_counter()
+        try:
+            while True:
+                try:
+                    x = self.input_queue.get(timeout=self.stats.interval if timeout is None else timeout)
+                    break
+                except Empty:
+                    if timeout is not None:
+                        raise
+                    # an idle worker still reports, the scaler waits for a fresh snapshot of every worker
+                    self.stats.report(self.stats_queue)
+        finally:
+            self.stats.get_wait += time.perf_counter() - t0
+        return x if is_local(self.input_queue) else ShmHandle.unpack(x)
+
+    def pack(self, x, q):
+        if self.shm_threshold is None or is_local(q):
+            return x
+        return ShmHandle.pack(x, self.shm_threshold)
+
+    def put_output(self, x):
+        if self.priority is not None:
+            x = Prioritized(x, self.priority, self.deadline)
+        t0 = time.perf_counter()
+        self.output_queue.put(self.pack(x, self.output_queue))
+        self.stats.put_wait += time.perf_counter() - t0
+        self.stats.items_out += 1
+
+    def get_batch(self):
+        # block for the first item, then gather until batch_size or max_wait_ms, a sentinel ends the batch early
+        batch = [self.get_item()]
+        if isinstance(batch[0], State):
+            return [], batch[0]
+        deadline = None
+        if self.max_wait_ms is not None:
+            deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    x = self.get_item()
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    x = self.get_item(timeout)
+            except Empty:
+                break
+            if isinstance(x, State):
+                return batch, x
+            batch.append(x)
+        return batch, None
+
+    def put_result(self, result):
+        if self.batch_size > 1:
+            if result is None or result is State.STOP:
+                result = [result]
+            for x in result:
+                if x is not None or self.outputs is not None:
+                    self.put_result_item(x)
+            return
+
+        self.put_result_item(result)
+
+    def put_result_item(self, x):
+        if x is State.STOP:
+            self.input_queue.put(State.STOP)
+        elif self.outputs is not None:
+            self.outputs.append(x)
+        elif self.checkpoint is not None:
+            # the run argument reaches the first stage unkeyed, every item it yields is a new input seq
+            seq = self.checkpoint.take()
+            if seq is not None:
+                self.put_output(Keyed(seq, Fraction(1), x))
+        else:
+            self.put_output(x)
+
     def main_loop(self, input_queue, output_queue):
         self.input_queue = input_queue
         self.output_queue = output_queue
+        self.tagged = getattr(input_queue, 'tagged', False)
+        self.stats = TaskStats(self.id, self.stage, self.name)
 
         try:
+            if self.placement is not None:
+                self.placement.apply(self.executor == Executor.PROCESS)
             if hasattr(self.fn, "init"):
                 self.fn.init()
+            if len(self.replay) > 0:
+                self.replay_items()
 
             while True:
-                x = self.input_queue.get()
-                if x == State.SHUTDOWN:
-                    break
-                if x == State.SHUTDOWN_LAST:
-                    self.output_queue.put(State.STOP)
-                    break
-                if x == State.STOP:
-                    for i in range(self.multiplicity-1):
-                        self.input_queue.put(State.SHUTDOWN)
-                    self.input_queue.put(State.SHUTDOWN_LAST)
-                    continue
+                if self.batch_size > 1:
+                    batch, x = self.get_batch()
+                    if len(batch) > 0:
+                        self.run_items(batch)
+                    if x is None:
+                        continue
+                else:
+                    x = self.get_item()
 
-                result = self.fn(x)
-                if inspect.isgenerator(result):
-                    for x in result:
-                        if x == State.STOP:
-                            self.input_queue.put(State.STOP)
-                            break
+                if (x is State.STOP or x is State.CLOSE) and self.inputs > 1:
+                    # a join ends its run once every branch has
+                    self.closed += 1
+                    if self.closed < self.inputs:
+                        continue
+                    self.closed = 0
+                if x is State.STOP and self.persistent:
+                    # end of one run, the workers stay alive and only STOP is passed on
+                    self.end_batch()
+                    continue
+                if x is State.STOP or x is State.CLOSE:
+                    # every worker exits on the sentinel, the last one out passes it downstream,
+                    # the final stats go first so the parent has them all once the sentinel is out
+                    self.stats.report(self.stats_queue, force=True)
+                    if self.input_queue.leave():
                         self.output_queue.put(x)
-                else:
-                    if result == State.STOP:
-                        self.input_queue.put(State.STOP)
                     else:
-                        self.output_queue.put(result)
+                        self.input_queue.put(x)
+                    break
+                if x is State.RETIRE:
+                    if self.input_queue.retire():
+                        break
+                    continue
+
+                self.run_items([x])
 
             if hasattr(self.fn, "shutdown"):
                 self.fn.shutdown()
 
         except KeyboardInterrupt:
             pass
-        except Exception:
+        except Exception as e:
             print("For {}".format(self.fn))
+            if self.errors is not None:
+                self.errors.put(TaskError(self.id, self.stage, self.name, repr(e), traceback.format_exc(),
+                    self.current))
             raise
+        finally:
+            self.stats.report(self.stats_queue, force=True)
 
+    def recover(self, error, requeue):
+        # called in the parent before a restart, the new worker replays the items the dead one held
+        # ahead of its queue, a worker that crashed without a report leaves none
+        self.replay, self.requeue = error.items or [], requeue
 
-class TaskPipeline(object):
-    def __init__(self):
+    def replay_items(self):
+        items, self.replay = self.replay, []
+        if self.requeue:
+            self.run_items(items)
+        elif self.ordered or self.tagged:
+            # the items are dropped but the Reorder or Join stage still waits for their seqs
+            for seq, _ in items:
+                self.put_output((seq, None if self.tagged else []))
+
+    def admit(self, items):
+        # unwraps prioritized items, the outputs of the batch take its highest class and earliest deadline,
+        # an item past its deadline is dropped unless the stage only restores order or joins
+        now = time.monotonic()
+        self.priority, self.deadline = None, None
+        admitted, expired = [], []
+        for item in items:
+            seq, x = item if self.ordered else (None, item)
+            if isinstance(x, Prioritized):
+                if x.deadline is not None and x.deadline < now and not isinstance(self.fn, (Join, Reorder)):
+                    expired.append((seq, x.value))
+                    continue
+                self.priority = max(self.priority or 0, x.priority)
+                if x.deadline is not None:
+                    self.deadline = min(self.deadline or x.deadline, x.deadline)
+                x = x.value
+            admitted.append(x if seq is None else (seq, x))
+
+        self.stats.expired += len(expired)
+        for seq, x in expired:
+            # the Reorder or Join stage still waits for the seq, a checkpointed input stays undone
+            if self.ordered:
+                self.put_output((seq, []))
+            elif self.tagged:
+                self.put_output((x[0], None))
+        return admitted
+
+    def run_items(self, items):
+        items = self.admit(items)
+        if len(items) == 0:
+            return
+        self.current = items
+        if self.checkpoint is not None and isinstance(items[0], Keyed):
+            self.run_keyed_fn(items)
+        elif self.ordered or self.tagged:
+            self.run_ordered_fn(items)
+        elif self.batch_size > 1:
+            self.run_fn(items)
+        else:
+            self.run_fn(items[0])
+        self.current = None
+
+    def end_batch(self):
+        # every worker of the stage arrives first, so the last item of the run is out before STOP
+        self.stats.report(self.stats_queue, force=True)
+        if self.input_queue.arrive():
+            self.output_queue.put(State.STOP)
+
+    def run_fn(self, x):
+        t0, put_wait = time.perf_counter(), self.stats.put_wait
+        self.stats.items_in += len(x) if self.batch_size > 1 else 1
+
+        result = self.fn(x)
+        if self.loop is not None:
+            result = self.run_async(result)
+        if inspect.isgenerator(result):
+            for x in result:
+                if x is State.STOP:
+                    self.input_queue.put(State.STOP)
+                    break
+                if self.cancel is not None and self.cancel.value != Cancel.NONE and \
+                        not isinstance(self.fn, (Join, Reorder)):
+                    # the consumer left the run, a source cut short still ends it, the stages that only
+                    # restore order or join hand on everything
+                    if self.cancel.value == Cancel.SOURCE and self.stage == 1:
+                        self.input_queue.put(State.STOP)
+                    break
+                # a batch stage generator yields its outputs one at a time, not a batch of them
+                self.put_result([x] if self.batch_size > 1 else x)
+        else:
+            self.put_result(result)
+
+        elapsed = time.perf_counter() - t0
+        self.stats.busy += elapsed - (self.stats.put_wait - put_wait)
+        self.stats.latency.append(elapsed)
+        self.stats.report(self.stats_queue)
+
+    def run_keyed_fn(self, items):
+        # the outputs of an item split its credit, an item without outputs hands it on alone,
+        # the parent logs the input seq once the whole credit is back
+        for x in items:
+            if x.empty:
+                self.put_output(x)
+        items = [x for x in items if not x.empty]
+        if len(items) == 0:
+            return
+        self.outputs = []
+        try:
+            self.run_fn([x.value for x in items] if self.batch_size > 1 else items[0].value)
+            outputs = self.outputs
+        finally:
+            self.outputs = None
+        if self.batch_size > 1:
+            if len(outputs) != len(items):
+                assert all(y is None for y in outputs), 'a checkpointed batch stage returns one output per item'
+                outputs = [None] * len(items)
+            groups = [[] if y is None else [y] for y in outputs]
+        else:
+            groups = [outputs]
+        for x, ys in zip(items, groups):
+            if len(ys) == 0:
+                self.put_output(Keyed(x.seq, x.credit, empty=True))
+            for y in ys:
+                self.put_output(Keyed(x.seq, x.credit / len(ys), y))
+
+    def run_ordered_fn(self, items):
+        # every input seq gets exactly one (seq, outputs) entry, the Reorder stage restores the order,
+        # inside a branch the entry is (seq, y) with y None, the single output or the list of outputs
+        seqs = [seq for seq, _ in items]
+        xs = [x for _, x in items]
+        self.outputs = []
+        try:
+            self.run_fn(xs if self.batch_size > 1 else xs[0])
+            outputs = self.outputs
+        finally:
+            self.outputs = None
+        if self.batch_size > 1:
+            assert len(outputs) == len(seqs)
+            for seq, y in zip(seqs, outputs):
+                self.put_output((seq, y if self.tagged else [] if y is None else [y]))
+        elif self.tagged:
+            self.put_output((seqs[0], outputs[0] if len(outputs) == 1 else outputs or None))
+        else:
+            self.put_output((seqs[0], outputs))
+
+
+class BasePipeline(object):
+    # worker bookkeeping shared by both pipelines, they keep tasks, a collector and a supervisor
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stats(self):
+        return self.collector.collect()
+
+    def show_stats(self, interval=None):
+        self.collector.show(self.alive, interval)
+
+    def alive(self):
+        return any(task.process.is_alive() for task in self.tasks if hasattr(task, 'process'))
+
+    def check(self, deadline=None):
+        # a failed run leaves no worker behind
+        try:
+            self.supervisor.check(self.tasks)
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError('no pipeline output for {}s'.format(self.supervisor.timeout))
+        except Exception:
+            self.terminate()
+            raise
+
+    def terminate(self):
+        for task in self.tasks:
+            if isinstance(getattr(task, 'process', None), Process) and task.process.is_alive():
+                task.process.terminate()
+
+    def reap(self, limit, report):
+        # the process workers get until limit to exit and are killed after it, the ones killed and the
+        # threads still running go to the close report
+        for task in self.tasks:
+            process = getattr(task, 'process', None)
+            if isinstance(process, Process):
+                process.join(None if limit is None else max(0, limit - time.monotonic()))
+                if process.is_alive():
+                    process.terminate()
+                    process.join(1)
+                    if process.is_alive():
+                        process.kill()
+                        process.join()
+                    report['killed'].append('{}:{}'.format(task.id, task.name))
+            elif process is not None and process.is_alive():
+                # a thread can not be killed, it is a daemon and ends with the interpreter
+                report['abandoned'].append('{}:{}'.format(task.id, task.name))
+
+
+class TaskPipeline(BasePipeline):
+    def __init__(self, persistent=False, shm_threshold=1 << 20, retries=0, requeue=False, timeout=None,
+            checkpoint=None, priorities=1):
+        # persistent: workers stay warm between runs and exit on close()
+        # shm_threshold: arrays of at least this many bytes cross process queues in shared memory, None disables
+        # retries: restarts allowed per worker, requeue: a restarted worker gets its in-flight items again
+        # timeout: seconds without any output before the run fails
+        # checkpoint: progress log path or Checkpoint, inputs are numbered as they are fed, or as the first stage
+        # yields them for run(arg), and a rerun with the same log skips the completed ones
+        # priorities: priority classes of every stage queue, see submit()
         self.tasks = []
-        self.input_queue = Queue(1)
+        self.input_queue = StageQueue(1)
         self.output_queue = Queue(1)
         self.nextId = 1
+        self.last = None
+        self.graph = []
+        self.stages = {}
+        self.loop, self.loop_thread = None, None
+        self.stage = 0
+        self.collector = StatsCollector()
+        self.persistent = persistent
+        self.shm_threshold = shm_threshold
+        self.supervisor = Supervisor(retries, requeue, timeout)
+        self.scaler = Scaler()
+        self.started = False
+        self.pending = None
+        # end of the last run and the workers that exited before it, see settle()
+        self.settled, self.gone = 0.0, set()
+        # read by the feeder and every worker while a consumer leaves a run early, see outputs()
+        self.cancel = Value('b', Cancel.NONE, lock=False)
+        self.checkpoint = Checkpoint(checkpoint) if isinstance(checkpoint, str) else checkpoint
+        self.priorities = priorities
 
-    def run(self, arg=None):
+    def start(self):
+        if self.pending is None:
+            # submit() never blocks, the feeder applies the backpressure of the first stage queue
+            self.pending = ThreadQueue()
+            threading.Thread(target=self.feed, name='TaskFeed', daemon=True).start()
+        if self.started:
+            return
+        self.collector.start()
+        self.build()
         for task in self.tasks:
             task.start()
-        self.input_queue.put(arg)
+        self.started, self.gone = True, set()
+        if any(stage.max_workers > stage.min_workers for stage in self.graph):
+            self.scaler.start(self)
+
+    def feed(self):
         while True:
-            x = self.output_queue.get()
-            if x == State.STOP:
+            x = self.pending.get()
+            if x is State.SHUTDOWN:
                 break
+            if self.cancel.value == Cancel.SUBMITTED and not isinstance(x, State):
+                continue
+            if isinstance(x, Feed):
+                for y in x.iterable:
+                    if self.cancel.value == Cancel.SUBMITTED:
+                        break
+                    if self.checkpoint is not None:
+                        seq = self.checkpoint.take()
+                        if seq is None:
+                            continue
+                        y = Keyed(seq, Fraction(1), y)
+                    self.input_queue.put(self.pack(y))
+                continue
+            self.input_queue.put(self.pack(x))
+
+    def pack(self, x):
+        if self.shm_threshold is None or is_local(self.input_queue):
+            return x
+        return ShmHandle.pack(x, self.shm_threshold)
+
+    def drain(self, until=State.STOP, limit=None, credit=True):
+        # limit: time.monotonic() after which the drain gives up with TimeoutError,
+        # credit: the outputs are delivered here and their inputs logged done, otherwise Keyed ones pass as they are
+        deadline = None
+        try:
+            while True:
+                if self.supervisor.timeout is not None and deadline is None:
+                    deadline = time.monotonic() + self.supervisor.timeout
+                if limit is not None and time.monotonic() > limit:
+                    raise TimeoutError('pipeline not drained in time')
+                try:
+                    x = self.output_queue.get(timeout=self.supervisor.interval)
+                except Empty:
+                    self.check(deadline)
+                    continue
+                deadline = None
+                if x is until:
+                    # without persistent the workers exit with the run
+                    self.started = self.started and self.persistent
+                    self.settle()
+                    if not self.persistent:
+                        self.stop()
+                    break
+                x = x if is_local(self.output_queue) else ShmHandle.unpack(x)
+                if isinstance(x, Prioritized):
+                    x = x.value
+                if isinstance(x, Keyed) and credit:
+                    self.checkpoint.credit(x.seq, x.credit)
+                    if x.empty:
+                        continue
+                    x = x.value
+                yield x
+        finally:
+            # an interrupted or failed run keeps the progress it made
+            if self.checkpoint is not None and credit:
+                self.checkpoint.flush()
+
+    def settle(self):
+        # the workers force their stats out before the sentinel, but on another queue, so the end of a run
+        # waits for those of every worker still alive or gone since the last run
+        tasks = [task for task in self.tasks if getattr(task, 'process', None) is not None]
+        self.collector.wait([task for task in tasks if task.process.is_alive() or task.id not in self.gone],
+                self.settled)
+        self.settled = time.monotonic()
+        self.gone = {task.id for task in tasks if not task.process.is_alive()}
+
+    def stop(self):
+        # the feeder and the stats reader of a run without persistent stop after its workers, the next run
+        # starts them again, so no thread holds on to an idle pipeline
+        if self.pending is not None:
+            self.pending.put(State.SHUTDOWN)
+            self.pending = None
+        for task in self.tasks:
+            if getattr(task, 'process', None) is not None:
+                task.process.join(1)
+        if not self.alive():
+            # their last snapshots are in the pipe ahead of the None that ends the reader
+            self.collector.stop()
+
+    def run(self, arg=None):
+        self.submit(arg)
+        for _ in self.drain():
+            pass
+
+    def submit(self, x, priority=0, deadline=None):
+        # priority: class below priorities, a higher one skips the submitted backlog and the waiting items
+        # of every stage, deadline: seconds from now after which the stages drop the item and its outputs
+        self.start()
+        if priority == 0 and deadline is None:
+            self.pending.put(x)
+            return
+        x = Prioritized(x, priority, None if deadline is None else time.monotonic() + deadline)
+        if priority > 0:
+            self.input_queue.put(self.pack(x))
+        else:
+            self.pending.put(x)
+
+    def terminate(self):
+        super().terminate()
+        self.started = False
+
+    def outputs(self, prefetch=1, submitted=True):
+        # yields the last stage outputs of the current run, at most prefetch of them wait in the parent,
+        # submitted: the STOP of the run is submitted, otherwise the source of the first stage yields it
+        buffer = ThreadQueue(max(1, prefetch))
+        errors = []
+        cancelled = threading.Event()
+
+        def _prefetch():
+            try:
+                for x in self.drain(credit=False):
+                    if x is not None and not cancelled.is_set():
+                        buffer.put(x)
+            except Exception as e:
+                errors.append(e)
+            buffer.put(State.STOP)
+
+        threading.Thread(target=_prefetch, name='TaskPrefetch', daemon=True).start()
+        x = None
+        try:
+            while True:
+                x = buffer.get()
+                if x is State.STOP:
+                    break
+                if not isinstance(x, Keyed):
+                    yield x
+                    continue
+                # an input is logged done once the consumer has its outputs, the buffered and discarded ones
+                # run again on resume
+                try:
+                    if not x.empty and x.value is not None:
+                        yield x.value
+                finally:
+                    self.checkpoint.credit(x.seq, x.credit)
+        finally:
+            if x is not State.STOP:
+                # the consumer stopped early, an endless source would never end the run: the feeder drops the
+                # backlog, the generators stop at their next output and the few items in flight are
+                # discarded, so the next run starts clean
+                self.cancel.value = Cancel.SUBMITTED if submitted else Cancel.SOURCE
+                cancelled.set()
+                while x is not State.STOP:
+                    x = buffer.get()
+                self.cancel.value = Cancel.NONE
+            if self.checkpoint is not None:
+                self.checkpoint.flush()
+        if errors:
+            raise errors[0]
+
+    def stream(self, arg=None, prefetch=1):
+        self.submit(arg)
+        return self.outputs(prefetch, submitted=False)
+
+    def imap(self, iterable, prefetch=1):
+        self.submit(Feed(iterable))
+        self.submit(State.STOP)
+        return self.outputs(prefetch)
+
+    def join(self):
+        # ends the submitted batch and returns the outputs of the last stage
+        self.submit(State.STOP)
+        return list(self.outputs())
+
+    def map(self, iterable):
+        return list(self.imap(iterable))
+
+    def close(self, timeout=None):
+        # the work in flight drains for up to timeout seconds, the process workers still alive after it are
+        # killed and whatever is left in the queues is discarded with its shared memory, then the threads the
+        # pipeline started stop with their queues, event loop and brokers, so the pipeline is done with,
+        # returns how many outputs were drained and items dropped, the killed workers and the threads left behind
+        limit = None if timeout is None else time.monotonic() + timeout
+        report = {'drained': 0, 'dropped': 0, 'killed': [], 'abandoned': []}
+        if self.started:
+            until = State.CLOSE if self.persistent else State.STOP
+            self.submit(until)
+            try:
+                # the outputs are dropped, so their inputs are not logged done
+                for x in self.drain(until, limit, credit=False):
+                    report['drained'] += 0 if isinstance(x, Keyed) and x.empty else 1
+            except (TimeoutError, TaskError) as e:
+                sys.stderr.write('close: {}\n'.format(e))
+            self.started = False
+
+        self.reap(limit, report)
+        if self.pending is not None:
+            while True:
+                try:
+                    x = self.pending.get_nowait()
+                except Empty:
+                    break
+                report['dropped'] += 0 if isinstance(x, State) else 1
+            self.pending.put(State.SHUTDOWN)
+            self.pending = None
+        queues = [stage.input_queue for stage in self.graph] + [self.output_queue]
+        for q in queues:
+            report['dropped'] += self.discard(q)
+        ShmHandle.reap()
+
+        for fn in {id(stage.tasks[0].fn): stage.tasks[0].fn for stage in self.graph}.values():
+            if isinstance(fn, Remote):
+                fn.close()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop, self.loop_thread = None, None
+        self.collector.close()
+        self.supervisor.close()
+        for q in queues:
+            # their feeder threads flush and exit
+            for queue in getattr(q, 'queues', [q]):
+                if not is_local(queue):
+                    queue.close()
+        return report
+
+    def discard(self, q):
+        # empties a queue nobody reads anymore, the shm blocks of the items are unlinked
+        n = 0
+        for queue in getattr(q, 'queues', [q]):
+            while True:
+                try:
+                    x = queue.get_nowait()
+                except (Empty, OSError, ValueError):
+                    break
+                if not isinstance(x, State):
+                    n += 1
+                    if not is_local(q):
+                        ShmHandle.unpack(x, discard=True)
+        return n
+
+    def add(self, func, fan_out=1, batch_size=1, max_wait_ms=None,
+            queue_size=1, policy=Policy.BLOCK, sample_every=1, ordered=False, reorder_size=None,
+            executor=Executor.PROCESS, name=None, after=None, cpus=None, numa_node=None, threads=None,
+            max_fan_out=None):
+        # after: upstream stage name or names, the previous stage by default,
+        # several names join those branches by seq and func gets a dict of their results
+        # cpus, numa_node: cpu set of the stage workers, threads: BLAS/OpenCV thread cap per process worker
+        # max_fan_out: the stage autoscales between fan_out and max_fan_out workers on queue pressure
+        if after is None:
+            upstream = [self.last] if self.last is not None else []
+        else:
+            upstream = [self.stages[x] for x in ([after] if isinstance(after, str) else after)]
+        if len(upstream) > 1:
+            upstream = [self.add_stage(Join([x.name for x in upstream]), upstream, executor=Executor.THREAD)]
+
+        placement = None
+        if cpus is not None or numa_node is not None or threads is not None:
+            placement = Placement(cpus, numa_node, threads)
+        if isinstance(func, Remote):
+            # fan_out threads share the broker, fan_out * batch_size bounds the items on the wire
+            func.batched, executor = batch_size > 1, Executor.THREAD
+        stage = self.add_stage(func, upstream, fan_out, batch_size, max_wait_ms, queue_size, policy, sample_every,
+                ordered, reorder_size, executor, name, placement, max_fan_out)
+        if stage.input_queue.ordered:
+            stage = self.add_stage(Reorder(stage.input_queue), [stage], executor=Executor.THREAD, name=stage.name)
+        self.stages[stage.name] = stage
+
+    def add_stage(self, func, upstream, fan_out=1, batch_size=1, max_wait_ms=None,
+            queue_size=1, policy=Policy.BLOCK, sample_every=1, ordered=False, reorder_size=None,
+            executor=Executor.PROCESS, name=None, placement=None, max_fan_out=None):
+        executor = Executor(executor)
+        workers = max(fan_out, max_fan_out or 0)
+        ordered = ordered and workers > 1
+        window = 0
+        if ordered:
+            # bounds the reorder buffer, must admit a full batch on every worker
+            window = max(reorder_size or 2 * workers * batch_size, workers * batch_size)
+
+        # a queue only needs the multiprocessing transport when a process stage sits on either side
+        local = executor != Executor.PROCESS and all(x.executor != Executor.PROCESS for x in upstream)
+        input_queue = StageQueue(queue_size, policy, sample_every, ordered, window, local, fan_out, self.priorities)
+        output_queue = Queue(1) if executor == Executor.PROCESS else ThreadQueue(1)
+        join = isinstance(func, Join)
+        for x in upstream:
+            self.connect(x, Tag(input_queue, x.name) if join else input_queue)
+        if len(upstream) == 0:
+            self.input_queue = input_queue
+        self.output_queue = output_queue
 
-    def add(self, func, fan_out=1):
-        input_queue = self.input_queue
-        output_queue = self.output_queue
-        if len(self.tasks):
-            input_queue = Queue(1)
-            self.tasks[-1].output_queue = input_queue
+        loop = None
+        if executor == Executor.ASYNC:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(target=self.loop.run_forever, name='TaskLoop', daemon=True)
+                self.loop_thread.start()
+            loop = self.loop
 
+        tasks = []
+        self.stage += 1
         for i in range(fan_out):
-            task = Task(self.nextId, func, input_queue, output_queue, fan_out)
+            task = Task(self.nextId, func, input_queue, output_queue, batch_size, max_wait_ms, ordered, executor,
+                    loop)
+            task.stage, task.stats_queue = self.stage, self.collector.queue
+            task.persistent = self.persistent
+            task.shm_threshold, task.errors = self.shm_threshold, self.supervisor.queue
+            task.inputs = len(upstream) if join else 1
+            task.placement = placement
+            task.checkpoint = self.checkpoint
+            task.cancel = self.cancel
             self.nextId += 1
             self.tasks.append(task)
+            tasks.append(task)
+
+        self.last = Stage(name or tasks[0].name, tasks, executor, input_queue, max_fan_out)
+        self.graph.append(self.last)
+        return self.last
+
+    def grow(self, stage):
+        task = copy.copy(stage.tasks[0])
+        task.id, task.replay, task.current = self.nextId, [], None
+        if not stage.input_queue.enter():
+            return
+        self.nextId += 1
+        stage.tasks.append(task)
+        self.tasks.append(task)
+        task.start()
+
+    def connect(self, stage, q):
+        stage.outputs.append(q)
+        if len(stage.outputs) == 2:
+            stage.branch = Branch(stage.outputs, self.shm_threshold)
+        for task in stage.tasks:
+            task.output_queue = q if stage.branch is None else stage.branch
+
+    def build(self):
+        # a run starts with fan_out workers per stage, the ones the scaler added are gone with the last run
+        for stage in self.graph:
+            extra = stage.tasks[stage.min_workers:]
+            self.tasks = [task for task in self.tasks if task not in extra]
+            stage.tasks = stage.tasks[:stage.min_workers]
+            stage.input_queue.live.value, stage.input_queue.arrived.value = len(stage.tasks), 0
+            stage.pressure = 0
+
+        # the stages below a branch point carry (seq, x) until a join strips the seq again
+        for stage in self.graph:
+            tagged = stage.input_queue.tagged and not isinstance(stage.tasks[0].fn, Join)
+            assert not (tagged and stage.input_queue.ordered), \
+                'stage {} sits inside a branch, the join restores the order'.format(stage.name)
+            assert not (tagged and stage.branch is not None), \
+                'stage {} branches inside a branch, nested branches are not supported'.format(stage.name)
+            assert self.checkpoint is None or not (stage.input_queue.ordered or stage.branch is not None), \
+                'stage {} reorders or branches, a checkpointed pipeline is linear'.format(stage.name)
+            # nothing reads the outputs of a branch left open, it would fill its queue and block the branch point
+            assert stage is self.last or len(stage.outputs) > 0, \
+                'stage {} ends a branch that never reaches a join or the last stage'.format(stage.name)
+            for q in stage.outputs:
+                if isinstance(q, StageQueue):
+                    q.tagged = tagged or stage.branch is not None
 
 # def input_func(x):
 #     for i in range(x):
@@ -129,11 +1734,98 @@ class TaskPipeline(object):
 #     def __call__(self, x):
 #         print('result', x)
 #
+# def batch_func(xs):
+#     return [x + 1 for x in xs]
+#
+# def batch_gen_func(xs):
+#     for x in xs:
+#         yield x * 2
+#
+# async def fetch_func(x):
+#     await asyncio.sleep(0.1)
+#     return x
+#
 # pipe = TaskPipeline()
 # pipe.add(input_func)
 # pipe.add(output_func)
+# pipe.add(batch_func, fan_out=2, batch_size=8, max_wait_ms=20)
+# pipe.add(batch_gen_func, batch_size=8)
+# pipe.add(output_func, queue_size=4, policy=Policy.DROP_OLDEST)
+# pipe.add(output_func, fan_out=4, ordered=True)
+# pipe.add(fetch_func, fan_out=8, executor=Executor.ASYNC)
+# pipe.add(batch_func, batch_size=8, executor=Executor.THREAD)
+# pipe.add(batch_func, fan_out=4, numa_node=0, threads=1)
+# pipe.add(output_func, fan_out=1, max_fan_out=8, queue_size=4)
 # pipe.add(ResultTest('test'))
 # pipe.run(5)
+# print(pipe.stats())
+#
+# pipe = TaskPipeline()
+# pipe.add(input_func)
+# pipe.add(output_func, fan_out=2)
+# for y in pipe.stream(5, prefetch=4):
+#     print('result', y)
+#
+# def frame_func(x):
+#     for i in range(x):
+#         yield np.full((1080, 1920, 3), i, dtype=np.uint8)
+#     yield State.STOP
+#
+# pipe = TaskPipeline(shm_threshold=1 << 20)
+# pipe.add(frame_func)
+# pipe.add(lambda frame: frame.mean(), fan_out=2)
+# print(list(pipe.stream(10)))
+#
+# def decode_func(x):
+#     for i in range(x):
+#         yield np.full((1080, 1920, 3), i, dtype=np.uint8)
+#     yield State.STOP
+#
+# pipe = TaskPipeline()
+# pipe.add(decode_func, name='decode')
+# pipe.add(lambda frame: frame.max(), name='detect', after='decode', fan_out=2)
+# pipe.add(lambda frame: frame.shape, name='pose', after='decode')
+# pipe.add(lambda frame: frame.mean(), name='ocr', after='decode')
+# pipe.add(ResultTest('join'), after=['detect', 'pose', 'ocr'])
+# pipe.run(10)
+#
+# pipe = TaskPipeline(retries=2, requeue=True, timeout=60)
+# pipe.add(input_func)
+# pipe.add(output_func, fan_out=4)
+# try:
+#     pipe.run(5)
+# except TaskError as e:
+#     print(e.name, e.error, e.items)
+#
+# with TaskPipeline(persistent=True) as pipe:
+#     pipe.add(output_func, fan_out=2)
+#     pipe.add(batch_func, batch_size=4, max_wait_ms=20)
+#     for i in range(3):
+#         print(pipe.map(range(10)))
+#
+# # bind the interface of the private network the workers share, never a public one
+# remote = Remote(('10.0.0.1', 6000))
+# print(remote.authkey.hex())
+# pipe = TaskPipeline()
+# pipe.add(input_func)
+# pipe.add(remote, fan_out=4, batch_size=16, max_wait_ms=5)
+# pipe.add(ResultTest('test'))
+# pipe.run(1000)
+# # on every worker host, one process per core:
+# # serve(('10.0.0.1', 6000), output_func, authkey=bytes.fromhex(key))
+#
+# with TaskPipeline(persistent=True, priorities=2) as pipe:
+#     pipe.add(output_func, fan_out=2, queue_size=8)
+#     pipe.add(ResultTest('test'))
+#     pipe.submit(Feed(range(10000)))
+#     pipe.submit(-1, priority=1, deadline=0.5)
+#     print(pipe.join())
+#
+# pipe = TaskPipeline(checkpoint='progress.log')
+# pipe.add(input_func)
+# pipe.add(output_func, fan_out=4)
+# pipe.add(ResultTest('test'))
+# pipe.run(100000)
 
 
 class ShmNumpy(object):
@@ -141,8 +1833,9 @@ class ShmNumpy(object):
         self.shm_size = int(np.prod(shape))
         self.mp_array = Array(dtype, self.shm_size, lock=Lock())
         self.np_array = np.frombuffer(self.mp_array.get_obj(), dtype=dtype)
-        self.dsize, self.ddim = Value('I', self.shm_size), Value('I', 3)
-        self.dshape = Array('I', shape)
+        self.dsize, self.ddim = Value('I', self.shm_size), Value('I', len(shape))
+        self.dshape = Array('I', ShmBlock.MAX_DIM)
+        self.dshape[:len(shape)] = shape
 
     @property
     def data(self):
@@ -150,7 +1843,7 @@ class ShmNumpy(object):
 
     @data.setter
     def data(self, d):
-        assert self.shm_size >= d.size
+        assert self.shm_size >= d.size and len(d.shape) <= ShmBlock.MAX_DIM
         self.np_array[:d.size] = d.ravel()
         self.ddim.value = len(d.shape)
         self.dshape[:len(d.shape)] = d.shape
@@ -158,7 +1851,7 @@ class ShmNumpy(object):
 
     @property
     def shape(self):
-        return self.dshape.value
+        return tuple(self.dshape[:self.ddim.value])
 
     def lock(self):
         self.mp_array.acquire()
@@ -167,12 +1860,245 @@ class ShmNumpy(object):
         self.mp_array.release()
 
 
+class ShmBlock(ABC):
+    # one shared memory block seen through numpy views, pickling only sends its name and the receiving
+    # process maps its own views, the creating process unlinks it
+    MAX_DIM = 8
+    VIEWS = ()
+
+    def create(self, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.owner = True
+        self._attach()
+
+    @abstractmethod
+    def _attach(self):
+        ...
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['name'] = self.shm.name
+        for key in ('shm',) + self.VIEWS:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop('name')
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        self._attach()
+
+    def close(self):
+        # a pipeline close() may have released it already
+        if self.shm is None:
+            return
+        for key in self.VIEWS:
+            setattr(self, key, None)
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+class ShmRing(ShmBlock):
+    # N-slot ring in one shared memory block, the header keeps (seq, ndim, *shape) per slot,
+    # a single producer fills slots in order and only the slot index travels through the pipe
+    VIEWS = ('header', 'buffer')
+
+    def __init__(self, dtype, shape, slots=4):
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.slot_size = int(np.prod(shape))
+        self.header_size = slots * (2 + self.MAX_DIM) * 8
+        self.free = Semaphore(slots)
+        self.wseq = 0
+        self.create(self.header_size + slots * self.slot_size * self.dtype.itemsize)
+        self.header[:] = 0
+
+    def _attach(self):
+        self.header = np.ndarray((self.slots, 2 + self.MAX_DIM), dtype=np.int64, buffer=self.shm.buf)
+        self.buffer = np.ndarray((self.slots, self.slot_size), dtype=self.dtype,
+                buffer=self.shm.buf, offset=self.header_size)
+
+    def acquire(self, shape, timeout=None):
+        assert len(shape) <= self.MAX_DIM and self.slot_size >= int(np.prod(shape))
+        if not self.free.acquire(True, timeout):
+            return -1, None
+        idx = self.wseq % self.slots
+        self.header[idx, 1] = len(shape)
+        self.header[idx, 2:2 + len(shape)] = shape
+        return idx, self.buffer[idx, :int(np.prod(shape))].reshape(shape)
+
+    def publish(self, idx):
+        self.wseq += 1
+        self.header[idx, 0] = self.wseq
+        return self.wseq
+
+    def write(self, d, timeout=None):
+        idx, buf = self.acquire(d.shape, timeout)
+        if idx >= 0:
+            buf[...] = d
+            self.publish(idx)
+        return idx
+
+    def read(self, idx, seq=None):
+        assert seq is None or self.header[idx, 0] == seq
+        ndim = self.header[idx, 1]
+        shape = tuple(self.header[idx, 2:2 + ndim])
+        return self.buffer[idx, :int(np.prod(shape))].reshape(shape)
+
+    def seq(self, idx):
+        return int(self.header[idx, 0])
+
+    def release(self, idx):
+        self.header[idx, 0] = 0
+        self.free.release()
+
+
+class ShmSpsc(ShmBlock):
+    # lock free handoff between the one producer and the one consumer of a linear TaskPipelineV2 link,
+    # head counts published slots and is only written by the producer, tail counts released slots and is
+    # only written by the consumer, each on its own cache line. aligned int64 stores are atomic and the
+    # pipe send after publish() orders the payload before the reader (x86 keeps stores in order as well),
+    # TaskV2 releases the input slot when the consumer stage returns, so stages never unlock by hand
+    VIEWS = ('counter', 'header', 'buffer')
+    spsc = True
+
+    def __init__(self, dtype, shape, slots=2):
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.slot_size = int(np.prod(shape))
+        self.header_size = 128 + slots * (1 + self.MAX_DIM) * 8
+        self.create(self.header_size + slots * self.slot_size * self.dtype.itemsize)
+        self.counter[:] = 0
+        self.header[:] = 0
+
+    def _attach(self):
+        self.counter = np.ndarray((2, 8), dtype=np.int64, buffer=self.shm.buf)
+        self.header = np.ndarray((self.slots, 1 + self.MAX_DIM), dtype=np.int64, buffer=self.shm.buf, offset=128)
+        self.buffer = np.ndarray((self.slots, self.slot_size), dtype=self.dtype,
+                buffer=self.shm.buf, offset=self.header_size)
+
+    def acquire(self, shape, timeout=None):
+        assert len(shape) <= self.MAX_DIM and self.slot_size >= int(np.prod(shape))
+        head = int(self.counter[0, 0])
+        spins, t0 = 0, time.monotonic()
+        # spin on the consumer's tail, then back off to short sleeps
+        while head - int(self.counter[1, 0]) >= self.slots:
+            if timeout is not None and time.monotonic() - t0 > timeout:
+                return -1, None
+            spins += 1
+            time.sleep(0 if spins < 10 else 0.0001)
+        idx = head % self.slots
+        self.header[idx, 0] = len(shape)
+        self.header[idx, 1:1 + len(shape)] = shape
+        return idx, self.buffer[idx, :int(np.prod(shape))].reshape(shape)
+
+    def publish(self):
+        self.counter[0, 0] += 1
+
+    def release(self):
+        self.counter[1, 0] += 1
+
+    @property
+    def data(self):
+        tail = int(self.counter[1, 0])
+        assert int(self.counter[0, 0]) > tail, 'nothing published'
+        idx = tail % self.slots
+        ndim = self.header[idx, 0]
+        shape = tuple(self.header[idx, 1:1 + ndim])
+        return self.buffer[idx, :int(np.prod(shape))].reshape(shape)
+
+    @data.setter
+    def data(self, d):
+        idx, buf = self.acquire(d.shape)
+        buf[...] = d
+        self.publish()
+
+    # ShmNumpy stage code runs unchanged, the slots are claimed by data= and released by TaskV2
+    def lock(self):
+        pass
+
+    def unlock(self):
+        pass
+
+
+class ShmRecord(ShmBlock):
+    # several named arrays of any dtype and shape in one shared memory block under one lock, the header is
+    # a count and a layout table of (name, dtype, offset, ndim, shape) rewritten by every assignment
+    ALIGN = 64
+    LAYOUT = np.dtype([('name', 'S32'), ('dtype', 'S16'), ('offset', '<i8'), ('ndim', '<i8'),
+        ('shape', '<i8', (ShmBlock.MAX_DIM,))])
+    VIEWS = ('count', 'table', 'buffer')
+
+    def __init__(self, nbytes, max_arrays=8):
+        self.nbytes = nbytes
+        self.max_arrays = max_arrays
+        self.header_size = -(-(8 + max_arrays * self.LAYOUT.itemsize) // self.ALIGN) * self.ALIGN
+        self.mutex = Lock()
+        self.create(self.header_size + nbytes)
+        self.count[0] = 0
+
+    def _attach(self):
+        self.count = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.table = np.ndarray((self.max_arrays,), dtype=self.LAYOUT, buffer=self.shm.buf, offset=8)
+        self.buffer = np.ndarray((self.nbytes,), dtype=np.uint8, buffer=self.shm.buf, offset=self.header_size)
+
+    @property
+    def data(self):
+        return {name: self.view(i) for i, name in enumerate(self.keys())}
+
+    @data.setter
+    def data(self, arrays):
+        assert len(arrays) <= self.max_arrays
+        offset = 0
+        for i, (name, d) in enumerate(arrays.items()):
+            d = np.asarray(d)
+            # the layout table truncates a longer name silently
+            assert len(name.encode()) <= self.LAYOUT['name'].itemsize, \
+                'array name {} is longer than {} bytes'.format(name, self.LAYOUT['name'].itemsize)
+            assert d.ndim <= self.MAX_DIM and not d.dtype.hasobject
+            assert offset + d.nbytes <= self.nbytes, \
+                'record exceeds its budget of {} bytes at {}'.format(self.nbytes, name)
+            shape = list(d.shape) + [0] * (self.MAX_DIM - d.ndim)
+            self.table[i] = (name.encode(), d.dtype.str.encode(), offset, d.ndim, shape)
+            self.view(i)[...] = d
+            offset = -(-(offset + d.nbytes) // self.ALIGN) * self.ALIGN
+        self.count[0] = len(arrays)
+
+    def view(self, i):
+        entry = self.table[i]
+        dtype, ndim, offset = np.dtype(entry['dtype'].decode()), int(entry['ndim']), int(entry['offset'])
+        shape = tuple(int(x) for x in entry['shape'][:ndim])
+        return self.buffer[offset:offset + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+
+    def keys(self):
+        return [self.table[i]['name'].decode() for i in range(int(self.count[0]))]
+
+    def __getitem__(self, name):
+        return self.view(self.keys().index(name))
+
+    def lock(self):
+        self.mutex.acquire()
+
+    def unlock(self):
+        self.mutex.release()
+
+
 class TaskV2(object):
     def __init__(self, id, func, input_pipe, output_pipe, inshms=[], outshms=[]):
         self.id = id
         self.fn = func
         self.input_pipe, self.output_pipe = input_pipe, output_pipe
         self.inshms, self.outshms = inshms, outshms
+        self.stats_queue = None
+        self.started = 0.0
+        self.errors = None
+        self.stage = id
+        self.name = getattr(func, '__name__', func.__class__.__name__)
+        self.placement = None
 
     def inshms(self):
         return self.inshms
@@ -181,61 +2107,135 @@ class TaskV2(object):
         return self.outshms
 
     def start(self):
+        self.started = time.monotonic()
         self.process = Process(target=self.main_loop, args=(self.input_pipe, self.output_pipe))
         self.process.start()
 
+    def recover(self, error, requeue):
+        # the in-flight message may hold shm slots only the stage knows how to replay, it is not resent
+        pass
+
+    def send(self, x):
+        t0 = time.perf_counter()
+        self.output_pipe.send(x)
+        self.stats.put_wait += time.perf_counter() - t0
+        self.stats.items_out += 1
+
     def main_loop(self, input_pipe, output_pipe):
+        self.stats = TaskStats(self.id, self.stage, self.name)
         try:
+            if self.placement is not None:
+                self.placement.apply()
             if hasattr(self.fn, "init"):
                 self.fn.init()
 
             while True:
+                self.stats.sample(int(self.input_pipe.poll()))
+                t0 = time.perf_counter()
                 x = self.input_pipe.recv()
+                self.stats.get_wait += time.perf_counter() - t0
                 # sys.stderr.write(f'<{x}>\n')
                 if x == State.STOP:
+                    self.stats.report(self.stats_queue, force=True)
                     self.output_pipe.send(State.STOP)
                     break
 
+                t0, put_wait = time.perf_counter(), self.stats.put_wait
+                self.stats.items_in += 1
                 result = self.fn(x, *self.inshms, *self.outshms)
                 if inspect.isgenerator(result):
                     for x in result:
-                        self.output_pipe.send(x)
+                        if x is State.STOP:
+                            # a source ends the run but keeps waiting for the next input
+                            self.stats.report(self.stats_queue, force=True)
+                        self.send(x)
                 else:
-                    self.output_pipe.send(result)
+                    self.send(result)
+                for shm in self.inshms:
+                    if getattr(shm, 'spsc', False):
+                        shm.release()
+                elapsed = time.perf_counter() - t0
+                self.stats.busy += elapsed - (self.stats.put_wait - put_wait)
+                self.stats.latency.append(elapsed)
+                self.stats.report(self.stats_queue)
 
             if hasattr(self.fn, "shutdown"):
                 self.fn.shutdown()
 
         except KeyboardInterrupt:
             pass
-        except Exception:
+        except Exception as e:
             print("For {}".format(self.fn))
+            if self.errors is not None:
+                self.errors.put(TaskError(self.id, self.stage, self.name, repr(e), traceback.format_exc()))
             raise
+        finally:
+            self.stats.report(self.stats_queue, force=True)
 
 
-class TaskPipelineV2(object):
-    def __init__(self):
+class TaskPipelineV2(BasePipeline):
+    def __init__(self, retries=0, timeout=None):
         self.tasks = []
         self.nextId = 1
         self.input_pipe, self.output_pipe = Pipe()
+        self.collector = StatsCollector()
+        self.supervisor = Supervisor(retries, timeout=timeout)
+
+    def close(self, timeout=None):
+        # the first stage waits for its next input after a run, STOP walks down the stages and lets them exit,
+        # the ones still alive after timeout seconds are killed and the shared memory of the links is released
+        limit = None if timeout is None else time.monotonic() + timeout
+        report = {'drained': 0, 'killed': [], 'abandoned': [], 'released': 0}
+        if self.alive():
+            self.input_pipe.send(State.STOP)
+            while self.alive() and (limit is None or time.monotonic() < limit):
+                if not self.output_pipe.poll(self.supervisor.interval):
+                    continue
+                x = self.output_pipe.recv()
+                if x == State.STOP:
+                    break
+                report['drained'] += 1
+
+        self.reap(limit, report)
+        for task in self.tasks:
+            for shm in task.outshms:
+                if hasattr(shm, 'close'):
+                    shm.close()
+                    report['released'] += 1
+        self.collector.close()
+        self.supervisor.close()
+        return report
 
     def run(self, x=None):
+        self.collector.start()
         for task in self.tasks:
             task.start()
         self.input_pipe.send(x)
+        deadline = None
         while True:
+            if self.supervisor.timeout is not None and deadline is None:
+                deadline = time.monotonic() + self.supervisor.timeout
+            if not self.output_pipe.poll(self.supervisor.interval):
+                self.check(deadline)
+                continue
+            deadline = None
             x = self.output_pipe.recv()
             if x == State.STOP:
+                self.collector.wait(self.tasks)
                 break
 
-    def add(self, fn, shms=[]):
+    def add(self, fn, shms=[], cpus=None, numa_node=None, threads=None):
         input_pipe, output_pipe = Pipe()
 
         inshms, outshms = [], shms
         if len(self.tasks) > 0:
             inshms = self.tasks[-1].outshms
 
-        self.tasks.append(TaskV2(self.nextId, fn, self.output_pipe, input_pipe, inshms, outshms))
+        task = TaskV2(self.nextId, fn, self.output_pipe, input_pipe, inshms, outshms)
+        task.stats_queue, task.errors = self.collector.queue, self.supervisor.queue
+        if cpus is not None or numa_node is not None or threads is not None:
+            task.placement = Placement(cpus, numa_node, threads)
+        self.tasks.append(task)
         self.nextId += 1
         self.output_pipe = output_pipe
 
@@ -264,4 +2264,65 @@ class TaskPipelineV2(object):
 # pipe.add(input_func, shms=[ShmNumpy('I', (640, 352, 3))])
 # pipe.add(output_func)
 # pipe.add(ResultTest('test'))
+# pipe.show_stats(interval=1)
+# pipe.run(10)
+# print(pipe.close(timeout=5))
+#
+# def ring_input_func(x, ring):
+#     for i in range(x):
+#         idx, frame = ring.acquire((640, 352, 3))
+#         frame[...] = i
+#         yield {'slot': idx, 'seq': ring.publish(idx)}
+#     yield State.STOP
+#
+# def ring_output_func(x, ring):
+#     frame = ring.read(x['slot'], x['seq'])
+#     sys.stderr.write(f'{frame[0, 0, :]}')
+#     ring.release(x['slot'])
+#
+# ring = ShmRing('I', (640, 352, 3), slots=8)
+# pipe = TaskPipelineV2()
+# pipe.add(ring_input_func, shms=[ring])
+# pipe.add(ring_output_func)
+# pipe.add(ResultTest('test'))
+# pipe.run(10)
+# ring.close()
+#
+# def spsc_input_func(x, frames):
+#     for i in range(x):
+#         frames.data = np.ones(frames.shape, dtype=np.uint8) * i
+#         yield {'a': i}
+#     yield State.STOP
+#
+# def spsc_output_func(x, frames):
+#     sys.stderr.write(f'{frames.data[0, 0, :]}')
+#
+# frames = ShmSpsc(np.uint8, (640, 352, 3), slots=4)
+# pipe = TaskPipelineV2()
+# pipe.add(spsc_input_func, shms=[frames])
+# pipe.add(spsc_output_func)
+# pipe.add(ResultTest('test'))
+# pipe.run(10)
+# frames.close()
+#
+# def record_input_func(x, record):
+#     for i in range(x):
+#         record.lock()
+#         record.data = {
+#             'frame': np.ones((640, 352, 3), dtype=np.uint8) * i,
+#             'mask': np.zeros((640, 352), dtype=bool),
+#             'keypoints': np.random.rand(17, 3).astype(np.float32)}
+#         yield {'a': i}
+#     yield State.STOP
+#
+# def record_output_func(x, record):
+#     sys.stderr.write(f'{record.keys()} {record["keypoints"].shape}')
+#     record.unlock()
+#
+# record = ShmRecord(4 << 20)
+# pipe = TaskPipelineV2()
+# pipe.add(record_input_func, shms=[record])
+# pipe.add(record_output_func)
+# pipe.add(ResultTest('test'))
 # pipe.run(10)
+# record.close()